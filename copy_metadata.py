@@ -1,9 +1,10 @@
 import os
 import pyexiv2
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
-from tqdm import tqdm
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from extract_metadata import pool_chunksize, pool_workers, progress
 
 """
 图像元数据批量复制工具
@@ -22,11 +23,55 @@ from tqdm import tqdm
    - 复制元数据
 """
 
+# 不复制的EXIF标签前缀：缩略图IFD中的偏移量指向源JPG内部，写入TIFF后无效
+SKIPPED_EXIF_PREFIXES = ('Exif.Thumbnail.',)
+
+def copy_metadata(src_path: Union[str, Path], dst_path: Union[str, Path]) -> Tuple[bool, Optional[str]]:
+    """
+    复制元数据从JPG到TIFF（模块级函数，便于在进程池中调用）
+    
+    Args:
+        src_path: 源JPG文件路径
+        dst_path: 目标TIFF文件路径
+        
+    Returns:
+        Tuple[bool, Optional[str]]: (操作是否成功, 错误信息)，错误信息由主进程统一输出
+    """
+    try:
+        # 读取源文件元数据
+        with pyexiv2.Image(str(src_path)) as src_img:
+            exif_data = src_img.read_exif()
+            xmp_data = src_img.read_xmp()
+        
+        exif_data = {
+            tag: value for tag, value in exif_data.items()
+            if not tag.startswith(SKIPPED_EXIF_PREFIXES)
+        }
+        
+        # 没有可写入的元数据时无需打开目标文件
+        if not exif_data and not xmp_data:
+            return True, None
+            
+        # 写入目标文件（同一句柄内完成EXIF和XMP写入）
+        with pyexiv2.Image(str(dst_path)) as dst_img:
+            # 写入EXIF数据
+            if exif_data:
+                dst_img.modify_exif(exif_data)
+            
+            # 写入XMP数据
+            if xmp_data:
+                dst_img.modify_xmp(xmp_data)
+                
+        return True, None
+        
+    except Exception as e:
+        return False, f"错误: 处理 {os.path.basename(src_path)} -> {os.path.basename(dst_path)} 时出错 ({str(e)})"
+
 class MetadataCopier:
     """元数据复制器"""
     
     @staticmethod
-    def find_image_pairs(src_dir: Path, dst_dir: Path) -> List[Tuple[Path, Path]]:
+    def find_image_pairs(src_dir: Path, dst_dir: Path) -> List[Tuple[str, str]]:
         """
         查找源目录和目标目录中的对应图像对
         
@@ -35,69 +80,51 @@ class MetadataCopier:
             dst_dir: 目标目录路径（TIFF文件）
             
         Returns:
-            List[Tuple[Path, Path]]: 匹配的图像对列表 [(jpg_path, tiff_path), ...]
+            List[Tuple[str, str]]: 匹配的图像对列表 [(jpg_path, tiff_path), ...]
         """
-        # 获取所有JPG文件(不区分大小写)
-        jpg_files = list(src_dir.glob('*.[Jj][Pp][Gg]'))
-        if not jpg_files:
+        # 获取所有JPG文件(不区分大小写)，每个目录只扫描一次
+        # 目录无法读取（如无权限）时只跳过当前文件夹，不中断其他文件夹的处理
+        try:
+            with os.scandir(src_dir) as it:
+                jpg_entries = [e for e in it if e.name.lower().endswith(('.jpg', '.jpeg'))]
+        except OSError as e:
+            print(f"警告: 无法读取 {src_dir} ({str(e)})")
+            return []
+        if not jpg_entries:
             print(f"警告: {src_dir} 中未找到JPG文件")
             return []
             
         # 获取所有TIFF文件
-        tiff_files = {
-            f.stem: f for f in dst_dir.glob('*.tif*')
-        }
+        try:
+            with os.scandir(dst_dir) as it:
+                tiff_files = {
+                    os.path.splitext(e.name)[0]: e.path for e in it
+                    if e.name.lower().endswith(('.tif', '.tiff'))
+                }
+        except OSError as e:
+            print(f"警告: 无法读取 {dst_dir} ({str(e)})")
+            return []
         
         # 匹配文件对
         pairs = []
-        for jpg_file in jpg_files:
-            tiff_file = tiff_files.get(jpg_file.stem)
-            if tiff_file:
-                pairs.append((jpg_file, tiff_file))
+        for jpg_entry in jpg_entries:
+            tiff_path = tiff_files.get(os.path.splitext(jpg_entry.name)[0])
+            if tiff_path:
+                pairs.append((jpg_entry.path, tiff_path))
             else:
-                print(f"警告: 未找到与 {jpg_file.name} 对应的TIFF文件")
+                print(f"警告: 未找到与 {jpg_entry.name} 对应的TIFF文件")
                 
         return pairs
 
-    def copy_metadata(self, src_path: Path, dst_path: Path) -> bool:
+    def find_folder_pairs(self, folder_path: Path) -> List[Tuple[str, str]]:
         """
-        复制元数据从JPG到TIFF
+        验证子文件夹结构并查找其中的图像对
         
         Args:
-            src_path: 源JPG文件路径
-            dst_path: 目标TIFF文件路径
+            folder_path: 子文件夹路径
             
         Returns:
-            bool: 操作是否成功
-        """
-        try:
-            # 读取源文件元数据
-            with pyexiv2.Image(str(src_path)) as src_img:
-                exif_data = src_img.read_exif()
-                xmp_data = src_img.read_xmp()
-                
-            # 写入目标文件
-            with pyexiv2.Image(str(dst_path)) as dst_img:
-                # 写入EXIF数据
-                if exif_data:
-                    dst_img.modify_exif(exif_data)
-                
-                # 写入XMP数据
-                if xmp_data:
-                    dst_img.modify_xmp(xmp_data)
-                    
-            return True
-            
-        except Exception as e:
-            print(f"错误: 处理 {src_path.name} -> {dst_path.name} 时出错 ({str(e)})")
-            return False
-
-    def process_single_folder(self, folder_path: Path) -> None:
-        """
-        处理单个子文件夹
-        
-        Args:
-            folder_path: 子文件夹路径
+            List[Tuple[str, str]]: 匹配的图像对列表，目录无效时为空
         """
         input_dir = folder_path / "input_dir"
         out_dir = folder_path / "out_dir"
@@ -105,34 +132,84 @@ class MetadataCopier:
         # 验证目录
         if not input_dir.is_dir():
             print(f"跳过: {folder_path.name} - input_dir不存在")
-            return
+            return []
             
         if not out_dir.is_dir():
             print(f"跳过: {folder_path.name} - out_dir不存在")
-            return
-            
-        print(f"\n处理文件夹: {folder_path.name}")
-        print(f"input_dir: {input_dir}")
-        print(f"out_dir: {out_dir}")
+            return []
         
         # 查找匹配的文件对
         image_pairs = self.find_image_pairs(input_dir, out_dir)
         
         if not image_pairs:
             print(f"警告: {folder_path.name} 中未找到匹配的图像对")
-            return
+            return []
             
+        return image_pairs
+
+    @staticmethod
+    def submit_pairs(executor: ProcessPoolExecutor,
+                     image_pairs: List[Tuple[str, str]]) -> Iterator[Tuple[bool, Optional[str]]]:
+        """
+        将图像对提交到进程池
+        
+        Args:
+            executor: 进程池
+            image_pairs: 图像对列表
+            
+        Returns:
+            Iterator[Tuple[bool, Optional[str]]]: 按提交顺序返回的处理结果
+        """
+        src_files, dst_files = zip(*image_pairs)
+        return executor.map(copy_metadata, src_files, dst_files,
+                            chunksize=pool_chunksize(len(image_pairs)))
+
+    @staticmethod
+    def report_results(folder_path: Path, image_pairs: List[Tuple[str, str]],
+                       results: Iterator[Tuple[bool, Optional[str]]]) -> None:
+        """
+        等待并汇总单个子文件夹的处理结果
+        
+        Args:
+            folder_path: 子文件夹路径
+            image_pairs: 图像对列表
+            results: submit_pairs返回的结果迭代器
+        """
+        # 在汇总结果时输出文件夹信息，多个文件夹共用进程池时输出仍按文件夹分组
+        print(f"\n处理文件夹: {folder_path.name}")
+        print(f"input_dir: {folder_path / 'input_dir'}")
+        print(f"out_dir: {folder_path / 'out_dir'}")
         print(f"找到 {len(image_pairs)} 对匹配的图像")
         
-        # 处理所有文件对
         success_count = 0
-        with tqdm(image_pairs, desc=f"复制元数据 - {folder_path.name}") as pbar:
-            for src_file, dst_file in pbar:
-                if self.copy_metadata(src_file, dst_file):
-                    success_count += 1
-                    
+        errors = []
+        for success, error in progress(results, len(image_pairs), f"复制元数据 - {folder_path.name}"):
+            if success:
+                success_count += 1
+            else:
+                errors.append(error)
+        
+        # 循环结束后统一输出错误信息，避免打断进度条
+        for error in errors:
+            print(error)
         print(f"完成 {folder_path.name}: 成功 {success_count}/{len(image_pairs)}")
 
+    def process_single_folder(self, folder_path: Path) -> None:
+        """
+        处理单个子文件夹
+        
+        Args:
+            folder_path: 子文件夹路径
+        """
+        image_pairs = self.find_folder_pairs(folder_path)
+        if not image_pairs:
+            return
+        
+        # 处理所有文件对
+        with ProcessPoolExecutor(max_workers=pool_workers()) as executor:
+            results = self.submit_pairs(executor, image_pairs)
+            self.report_results(folder_path, image_pairs, results)
+
     def process_all(self, main_dir: str = "main") -> None:
         """
         处理main目录下所有子文件夹
@@ -155,9 +232,17 @@ class MetadataCopier:
             
         print(f"找到 {len(subfolders)} 个子文件夹")
         
-        # 处理每个子文件夹
-        for folder in subfolders:
-            self.process_single_folder(folder)
+        # 所有子文件夹共用一个进程池，并预先提交全部任务，
+        # 使文件夹之间的处理相互重叠，进程池不会在文件夹切换时空闲
+        with ProcessPoolExecutor(max_workers=pool_workers()) as executor:
+            jobs = []
+            for folder in subfolders:
+                image_pairs = self.find_folder_pairs(folder)
+                if image_pairs:
+                    jobs.append((folder, image_pairs, self.submit_pairs(executor, image_pairs)))
+            
+            for folder, image_pairs, results in jobs:
+                self.report_results(folder, image_pairs, results)
             
         print("\n所有处理完成!")
 
@@ -1,11 +1,12 @@
 import os
+import re
+import sys
+import csv
 import pyexiv2
-import shutil
-import tempfile
 import argparse
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from tqdm import tqdm
 
 """
@@ -18,92 +19,146 @@ DJI 图像元数据提取工具
 - 将所有匹配的标签及其值导出到txt文件，文件名作为第一列
 """
 
-class MetadataProcessor:
-    """图像元数据处理器"""
+# 筛选关键字
+KEYWORDS = ['dji', 'gps', 'image', 'rtk']  # 添加rtk关键字
+# 预编译为单个正则表达式，一次扫描即可判断所有关键字
+_KEYWORD_PATTERN = re.compile('|'.join(map(re.escape, KEYWORDS)), re.IGNORECASE)
+
+# Windows下ProcessPoolExecutor最多支持61个工作进程，超出时直接报错
+_MAX_WINDOWS_WORKERS = 61
+
+def pool_workers() -> int:
+    """
+    进程池的工作进程数（copy_metadata.py和main.py共用）
     
-    def __init__(self):
-        """初始化处理器"""
-        self.temp_dir = self._create_temp_dir()
-        # 用于存储所有发现的标签名称
-        self.all_tags = set(['ImageName'])  # 始终包含图片名称
+    返回值:
+        int: CPU核数，Windows下不超过61
+    """
+    workers = os.cpu_count() or 1
+    if sys.platform == 'win32':
+        workers = min(workers, _MAX_WINDOWS_WORKERS)
+    return workers
+
+def pool_chunksize(total: int) -> int:
+    """
+    计算进程池按批次分发任务时的批次大小，摊薄每个文件的进程间通信开销
+    
+    参数:
+        total: 任务总数
         
-    def _create_temp_dir(self) -> Path:
-        """
-        创建临时工作目录
+    返回值:
+        int: 每批的任务数
+    """
+    return max(1, total // (pool_workers() * 4))
+
+def progress(iterable: Iterable, total: int, desc: str) -> tqdm:
+    """
+    创建各脚本共用的进度条
+    
+    参数:
+        iterable: 要遍历的对象
+        total: 总数
+        desc: 进度条描述
         
-        返回值:
-            Path: 临时目录路径
-        """
-        try:
-            temp_base = Path(tempfile.gettempdir())
-            temp_dir = temp_base / f'metadata_process_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
-            temp_dir.mkdir(parents=True, exist_ok=True)
-            return temp_dir
-        except Exception as e:
-            print(f"警告: 无法使用系统临时目录 ({str(e)})")
-            fallback_dir = Path.cwd() / f'temp_metadata_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
-            fallback_dir.mkdir(parents=True, exist_ok=True)
-            return fallback_dir
+    返回值:
+        tqdm: 进度条迭代器
+    """
+    # 限制进度条刷新频率，避免单张处理很快时频繁重绘
+    return tqdm(iterable, total=total, desc=desc,
+                mininterval=0.5, miniters=max(1, total // 100))
 
-    def extract_metadata(self, jpg_path: Union[str, Path]) -> Optional[Dict[str, str]]:
-        """
-        从单个JPG文件中提取元数据
+# 标签名是否匹配关键字的缓存（每个工作进程各自一份）
+# DJI图像的标签集合基本固定，首张图像之后只需查字典
+_tag_match_cache: Dict[str, bool] = {}
+
+def _is_wanted_tag(tag: str) -> bool:
+    """
+    判断标签名是否包含任一关键字（不区分大小写），结果按标签名缓存
+    
+    参数:
+        tag: 标签名称
         
-        参数:
-            jpg_path: JPG文件路径
-            
-        返回值:
-            Optional[Dict[str, str]]: 提取的元数据字典，提取失败返回None
-        """
-        temp_jpg = None
-        try:
-            jpg_path = Path(jpg_path)
-            temp_jpg = self.temp_dir / f"temp_{jpg_path.name}"
+    返回值:
+        bool: 是否需要提取该标签
+    """
+    matched = _tag_match_cache.get(tag)
+    if matched is None:
+        matched = _KEYWORD_PATTERN.search(tag) is not None
+        _tag_match_cache[tag] = matched
+    return matched
+
+def _open_image(jpg_path: Path) -> pyexiv2.Image:
+    """
+    打开图像以读取元数据
+    
+    直接按原路径打开，exiv2只读取元数据所在的段，不会读入整张图像。
+    旧版pyexiv2在Windows上无法打开中文等非ASCII路径，此时改为读入内存后解析。
+    
+    参数:
+        jpg_path: JPG文件路径
+        
+    返回值:
+        pyexiv2.Image: 已打开的图像对象
+    """
+    try:
+        return pyexiv2.Image(str(jpg_path))
+    except RuntimeError:
+        if str(jpg_path).isascii():
+            raise
+        with open(jpg_path, 'rb') as f:
+            return pyexiv2.ImageData(f.read())
+
+def extract_metadata(jpg_path: Union[str, Path]) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    """
+    从单个JPG文件中提取元数据（模块级函数，便于在进程池中调用）
+    
+    工作进程不直接输出信息，警告和错误随结果返回，由主进程统一输出，
+    避免与进度条争用控制台。
+    
+    参数:
+        jpg_path: JPG文件路径
+        
+    返回值:
+        Tuple[Optional[Dict[str, str]], Optional[str]]: (元数据字典, 警告或错误信息)，
+        提取成功时信息为None，提取失败时元数据为None
+    """
+    try:
+        jpg_path = Path(jpg_path)
+        
+        with _open_image(jpg_path) as img:
+            xmp_data = img.read_xmp()
+            exif_data = img.read_exif()
             
-            # 复制到临时目录
-            shutil.copy2(str(jpg_path), str(temp_jpg))
+            # 初始化元数据字典，添加图片名称
+            metadata = {'ImageName': jpg_path.name}
             
-            with pyexiv2.Image(str(temp_jpg)) as img:
-                xmp_data = img.read_xmp()
-                exif_data = img.read_exif()
-                
-                # 初始化元数据字典，添加图片名称
-                metadata = {'ImageName': jpg_path.name}
-                
-                # 筛选关键字
-                keywords = ['dji', 'gps', 'image', 'rtk']  # 添加rtk关键字
-                
-                # 处理XMP标签
-                for tag, value in xmp_data.items():
-                    tag_lower = tag.lower()
-                    if any(keyword in tag_lower for keyword in keywords):
-                        metadata[tag] = str(value).lstrip('+')  # 移除可能的前导加号
-                        self.all_tags.add(tag)  # 记录标签名称
+            # 处理XMP标签
+            for tag, value in xmp_data.items():
+                if _is_wanted_tag(tag):
+                    metadata[tag] = str(value).lstrip('+')  # 移除可能的前导加号
 
-                # 处理EXIF标签
-                for tag, value in exif_data.items():
-                    tag_lower = tag.lower()
-                    if any(keyword in tag_lower for keyword in keywords):
-                        metadata[tag] = str(value).lstrip('+')  # 移除可能的前导加号
-                        self.all_tags.add(tag)  # 记录标签名称
-                
-                # 验证是否找到任何元数据
-                if len(metadata) <= 1:  # 只有ImageName
-                    print(f"警告: {jpg_path.name} 中未找到匹配的元数据")
-                    return None
-                    
-                return metadata
+            # 处理EXIF标签
+            for tag, value in exif_data.items():
+                if _is_wanted_tag(tag):
+                    metadata[tag] = str(value).lstrip('+')  # 移除可能的前导加号
+            
+            # 验证是否找到任何元数据
+            if len(metadata) <= 1:  # 只有ImageName
+                return None, f"警告: {jpg_path.name} 中未找到匹配的元数据"
                 
-        except Exception as e:
-            print(f"错误: 处理 {jpg_path.name} 时出错 ({str(e)})")
-            return None
-        finally:
-            if temp_jpg and temp_jpg.exists():
-                try:
-                    temp_jpg.unlink()
-                except Exception:
-                    pass
+            return metadata, None
+            
+    except Exception as e:
+        return None, f"错误: 处理 {jpg_path.name} 时出错 ({str(e)})"
 
+class MetadataProcessor:
+    """图像元数据处理器"""
+    
+    def __init__(self):
+        """初始化处理器"""
+        # 用于存储所有发现的标签名称
+        self.all_tags = set(['ImageName'])  # 始终包含图片名称
+        
     def save_to_txt(self, data: List[Dict[str, str]], folder_path: Union[str, Path]) -> None:
         """
         将元数据保存为metadata.txt文件
@@ -116,26 +171,44 @@ class MetadataProcessor:
             return
             
         output_path = Path(folder_path) / "metadata.txt"
-        
-        # 构建字段列表，确保ImageName为第一列
-        other_tags = sorted(list(self.all_tags - {'ImageName'}))  # 移除ImageName并对其他标签排序
-        fieldnames = ['ImageName'] + other_tags  # 将ImageName放在开头
+        fieldnames = self._build_fieldnames()
         
         print(f"\n发现的标签数量: {len(fieldnames)}")
         
-        with output_path.open('w', encoding='utf-8') as txtfile:
+        with output_path.open('w', encoding='utf-8', newline='', buffering=1 << 20) as txtfile:
+            writer = csv.writer(txtfile, lineterminator='\n')
             # 写入表头
-            txtfile.write(','.join(fieldnames) + '\n')
+            writer.writerow(fieldnames)
             
-            # 写入数据行
-            for row in data:
-                values = []
-                for field in fieldnames:
-                    values.append(str(row.get(field, '')))  # 如果标签不存在则使用空字符串
-                txtfile.write(','.join(values) + '\n')
+            # 写入数据行（如果标签不存在则使用空字符串）
+            writer.writerows([row.get(field, '') for field in fieldnames] for row in data)
         
         print(f"已生成: {output_path}")
 
+    def _build_fieldnames(self) -> List[str]:
+        """
+        根据当前已发现的标签构建字段列表
+        
+        返回值:
+            List[str]: 字段列表，ImageName为第一列，其余标签排序
+        """
+        other_tags = sorted(list(self.all_tags - {'ImageName'}))  # 移除ImageName并对其他标签排序
+        return ['ImageName'] + other_tags  # 将ImageName放在开头
+
+    @staticmethod
+    def _read_rows(output_path: Path) -> List[Dict[str, str]]:
+        """
+        读回已写入metadata.txt的数据行
+        
+        参数:
+            output_path: metadata.txt路径
+            
+        返回值:
+            List[Dict[str, str]]: 数据行列表
+        """
+        with output_path.open('r', encoding='utf-8', newline='') as txtfile:
+            return list(csv.DictReader(txtfile))
+
     @staticmethod
     def find_subfolders(base_dir: Union[str, Path]) -> List[Path]:
         """
@@ -154,9 +227,11 @@ class MetadataProcessor:
             return subfolders
         
         try:
-            for item in base_dir.iterdir():
-                if item.is_dir():
-                    subfolders.append(item)
+            # os.scandir的DirEntry缓存了文件类型，无需逐项stat
+            with os.scandir(base_dir) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subfolders.append(Path(entry.path))
         except Exception as e:
             print(f"警告: 搜索文件夹时出错 ({str(e)})")
         
@@ -171,30 +246,89 @@ class MetadataProcessor:
         """
         folder_path = Path(folder_path)
         
-        if not folder_path.is_dir():
-            print(f"错误: {folder_path} 不是有效目录")
+        # 收集所有JPG文件（单次扫描，不区分大小写）
+        # 目录无效或无法读取（如无权限）时由scandir直接报错，无需事先单独stat
+        # 只跳过当前文件夹，不中断其他文件夹的处理
+        try:
+            with os.scandir(folder_path) as it:
+                jpg_files = sorted(Path(entry.path) for entry in it
+                                   if entry.is_file() and entry.name.lower().endswith('.jpg'))
+        except OSError as e:
+            print(f"错误: {folder_path} 不是有效目录 ({str(e)})")
             return
         
-        # 收集所有JPG文件
-        jpg_files = list(folder_path.glob('*.jpg')) + list(folder_path.glob('*.JPG'))
-        
         if not jpg_files:
             print(f"警告: {folder_path} 中未找到JPG文件")
             return
             
         print(f"\n处理文件夹: {folder_path.name}")
-        metadata_list = []
         
-        # 使用进度条处理文件
-        for jpg_file in tqdm(jpg_files, desc="提取元数据"):
-            metadata = self.extract_metadata(jpg_file)
-            if metadata:
-                metadata_list.append(metadata)
+        # 使用进程池并行提取，结果按文件顺序返回
+        with ProcessPoolExecutor(max_workers=pool_workers()) as executor:
+            results = executor.map(extract_metadata, jpg_files,
+                                   chunksize=pool_chunksize(len(jpg_files)))
+            self.write_results(results, len(jpg_files), folder_path)
+
+    def write_results(self, results: Iterable[Tuple[Optional[Dict[str, str]], Optional[str]]],
+                      total: int, folder_path: Union[str, Path], desc: str = "提取元数据") -> None:
+        """
+        逐条接收提取结果并写入metadata.txt
+        
+        参数:
+            results: (元数据字典, 警告或错误信息) 的可迭代对象，通常来自进程池
+            total: 结果总数，用于显示进度
+            folder_path: 输出文件夹路径
+            desc: 进度条描述
+        """
+        folder_path = Path(folder_path)
+        output_path = folder_path / "metadata.txt"
+        txtfile = None
+        writer = None
+        fieldnames = []
+        row_count = 0
+        # 表头确定后若又发现新标签，之后的行暂存于此，最后统一重写
+        pending_rows = []
+        # 各文件的警告和错误信息，处理结束后统一输出
+        errors = []
+        
+        try:
+            for metadata, error in progress(results, total, desc):
+                if error:
+                    errors.append(error)
+                if not metadata:
+                    continue
+                # 在主进程中汇总标签名称
+                self.all_tags.update(metadata.keys())
+                row_count += 1
                 
-        if metadata_list:
-            self.save_to_txt(metadata_list, folder_path)
-        else:
+                # 收到第一行时以当前标签集合作为表头，之后逐行写入
+                if txtfile is None:
+                    fieldnames = self._build_fieldnames()
+                    txtfile = output_path.open('w', encoding='utf-8', newline='',
+                                               buffering=1 << 20)
+                    writer = csv.writer(txtfile, lineterminator='\n')
+                    writer.writerow(fieldnames)
+                
+                if pending_rows or len(self.all_tags) > len(fieldnames):
+                    pending_rows.append(metadata)
+                else:
+                    writer.writerow([metadata.get(field, '') for field in fieldnames])
+        finally:
+            if txtfile is not None:
+                txtfile.close()
+        
+        for error in errors:
+            print(error)
+                
+        if not row_count:
             print(f"警告: {folder_path.name} 中未提取到有效元数据")
+        elif pending_rows:
+            # 标签集合在中途扩展（同一文件夹内的DJI图像通常不会出现），
+            # 读回已写入的行后按完整表头重写
+            self.save_to_txt(self._read_rows(output_path) + pending_rows, folder_path)
+        else:
+            print(f"\n发现的标签数量: {len(fieldnames)}")
+            print(f"已生成: {output_path}")
 
     def process_all(self, root_dir: str = "main") -> None:
         """
@@ -226,13 +360,6 @@ class MetadataProcessor:
             
         except Exception as e:
             print(f"错误: {str(e)}")
-        finally:
-            # 清理临时目录
-            try:
-                if self.temp_dir.exists():
-                    shutil.rmtree(self.temp_dir)
-            except Exception as e:
-                print(f"警告: 清理临时文件失败 ({str(e)})")
 
 def main():
     """主函数"""
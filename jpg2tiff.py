@@ -2,12 +2,15 @@ import os
 import shutil
 import platform
 import subprocess
+import tempfile
+import threading
 import argparse
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
 from PIL import Image
 import piexif
-from tqdm import tqdm
 import numpy as np
+from extract_metadata import progress
 
 """
 DJI 图像批处理工具 - 精简版
@@ -16,17 +19,30 @@ DJI 图像批处理工具 - 精简版
 2. 文件分类整理
 """
 
+# 每个线程复用的float32输出缓冲区，避免每张图像重新分配内存
+_thread_buffers = threading.local()
+
+def _get_buffer(shape: Tuple[int, int]) -> np.ndarray:
+    """获取当前线程的float32缓冲区，尺寸变化时重新分配"""
+    buf = getattr(_thread_buffers, 'buf', None)
+    if buf is None or buf.shape != shape:
+        buf = _thread_buffers.buf = np.empty(shape, dtype=np.float32)
+    return buf
+
 class ImageProcessor:
     """图像处理器"""
     
     # 目录名称常量
     INPUT_DIR_NAME = "input_dir"  # 存放原始图像
     OUTPUT_DIR_NAME = "out_dir"   # 存放转换后的图像
-    TEMP_DIR_NAME = "temp_dir"   # 临时文件目录
+    TEMP_DIR_NAME = "temp_dir"   # 临时文件目录名前缀（位于系统临时目录）
     
     # 支持的图像格式
     SUPPORTED_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
     
+    # DJI Thermal SDK可执行文件所在目录
+    SDK_BIN_DIR = os.path.join("dji_thermal_sdk_v1.5_20240507", "utility", "bin")
+    
     # 测量参数默认值（用于DJI SDK）
     DEFAULT_MEASURE_PARAMS = {
         "distance": 5,      # 测量距离(米)
@@ -36,102 +52,183 @@ class ImageProcessor:
     }
 
     def __init__(self):
-        """初始化处理器，确定运行平台"""
+        """初始化处理器，确定运行平台及SDK可执行文件路径"""
         self.platform = platform.system()
+        
+        # 只解析一次SDK可执行文件的绝对路径（相对于本脚本所在目录），不受工作目录影响
+        sdk_bin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.SDK_BIN_DIR)
+        if self.platform == "Windows":
+            sdk_exe = os.path.join(sdk_bin_dir, "windows", "release_x64", "dji_irp.exe")
+        else:
+            sdk_exe = os.path.join(sdk_bin_dir, "linux", "release_x64", "dji_irp")
+        self._sdk_argv_prefix = [sdk_exe]
+        # 隐藏DJI SDK的输出（各平台统一使用subprocess.DEVNULL）
+        self._devnull = subprocess.DEVNULL
 
     def process_subfolders(self, parent_dir: str = "main") -> None:
         """处理指定父目录下所有子文件夹"""
         if not os.path.exists(parent_dir):
             raise FileNotFoundError(f"未找到父目录: {parent_dir}")
 
-        subfolders = [f for f in os.listdir(parent_dir)
-                     if os.path.isdir(os.path.join(parent_dir, f))]
+        subfolders = self.find_subfolders(parent_dir)
         
         if not subfolders:
             print(f"在{parent_dir}中未找到子文件夹")
             return
             
         for subfolder in subfolders:
-            subfolder_path = os.path.join(parent_dir, subfolder)
-            print(f"\n处理: {subfolder}")
-            self._process_single_folder(subfolder_path)
+            print(f"\n处理: {subfolder.name}")
+            self._process_single_folder(subfolder.path)
+
+    @staticmethod
+    def find_subfolders(parent_dir: str) -> List[os.DirEntry]:
+        """查找父目录下的所有子文件夹"""
+        # os.scandir的DirEntry缓存了文件类型，无需逐项stat
+        with os.scandir(parent_dir) as it:
+            return [entry for entry in it if entry.is_dir()]
 
     def _process_single_folder(self, folder_path: str) -> None:
         """处理单个红外文件夹"""
         # 创建所需的子目录
-        input_dir = self._create_directory(folder_path, self.INPUT_DIR_NAME)
-        output_dir = self._create_directory(folder_path, self.OUTPUT_DIR_NAME)
-        temp_dir = self._create_directory(folder_path, self.TEMP_DIR_NAME)
+        input_dir, output_dir, temp_dir = self.create_folder_dirs(folder_path)
 
         try:
             # 整理文件并处理
             self._move_files_and_process(folder_path, input_dir, output_dir, temp_dir)
         finally:
             # 清理临时目录
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def create_folder_dirs(self, folder_path: str) -> Tuple[str, str, str]:
+        """创建子文件夹所需的input_dir、out_dir和temp_dir，返回三者路径"""
+        input_dir = self._create_directory(folder_path, self.INPUT_DIR_NAME)
+        output_dir = self._create_directory(folder_path, self.OUTPUT_DIR_NAME)
+        # RAW中间文件写入系统临时目录（通常位于更快的本地磁盘或tmpfs），不占用数据盘IO
+        temp_dir = tempfile.mkdtemp(prefix=f"{self.TEMP_DIR_NAME}_")
+        return input_dir, output_dir, temp_dir
 
     def _create_directory(self, parent_path: str, dir_name: str) -> str:
-        """创建目录，如果已存在则先删除"""
+        """创建目录，如果已存在则保留其中内容（中断后可继续处理）"""
         dir_path = os.path.join(parent_path, dir_name)
-        if os.path.exists(dir_path):
-            shutil.rmtree(dir_path)
-        os.makedirs(dir_path)
+        os.makedirs(dir_path, exist_ok=True)
         return dir_path
 
+    def collect_images(self, src_dir: str, input_dir: str, output_dir: str) -> Tuple[List[str], List[str]]:
+        """
+        将新图像移入input_dir，并找出尚未转换的图像
+        
+        返回:
+            (input_dir中的全部图像文件名, 其中尚无对应TIFF的文件名)
+        """
+        # 移动新加入的图像文件
+        with os.scandir(src_dir) as it:
+            new_files = [entry.name for entry in it
+                         if entry.is_file() and entry.name.lower().endswith(self.SUPPORTED_IMAGE_EXTENSIONS)]
+        # input_dir是src_dir的子目录，位于同一文件系统，重命名只需一次系统调用
+        # 使用os.replace，input_dir中已有同名文件时直接覆盖（os.rename在Windows下会报错）
+        for filename in new_files:
+            os.replace(os.path.join(src_dir, filename),
+                       os.path.join(input_dir, filename))
+        
+        # 只转换out_dir中尚无对应TIFF的图像，重复运行时跳过已完成的文件
+        with os.scandir(output_dir) as it:
+            converted = {os.path.splitext(entry.name)[0] for entry in it
+                         if entry.name.lower().endswith(".tiff")}
+        with os.scandir(input_dir) as it:
+            input_files = sorted(entry.name for entry in it
+                                 if entry.is_file() and entry.name.lower().endswith(self.SUPPORTED_IMAGE_EXTENSIONS))
+        image_files = [f for f in input_files if os.path.splitext(f)[0] not in converted]
+        if len(image_files) < len(input_files):
+            print(f"跳过已转换的图像: {len(input_files) - len(image_files)} 张")
+        
+        # 主干相同的图像（如x.jpg与x.JPG、x.png）会输出到同一个TIFF，
+        # 并行转换时相互覆盖，无法确定结果对应哪张原图，因此全部跳过
+        stems: Dict[str, List[str]] = {}
+        for filename in image_files:
+            stems.setdefault(os.path.splitext(filename)[0], []).append(filename)
+        duplicates = set()
+        for stem, names in stems.items():
+            if len(names) > 1:
+                print(f"警告: {', '.join(names)} 将输出到同一文件 {stem}.tiff，已跳过转换")
+                duplicates.update(names)
+        if duplicates:
+            image_files = [f for f in image_files if f not in duplicates]
+        return input_files, image_files
+
     def _move_files_and_process(self, src_dir: str, input_dir: str, output_dir: str, 
                              temp_dir: str) -> None:
         """移动文件并进行处理"""
-        # 移动图像文件
-        image_files = [f for f in os.listdir(src_dir) 
-                      if f.lower().endswith(self.SUPPORTED_IMAGE_EXTENSIONS)]
-        for filename in image_files:
-            shutil.move(os.path.join(src_dir, filename), 
-                       os.path.join(input_dir, filename))
+        _, image_files = self.collect_images(src_dir, input_dir, output_dir)
             
         # 处理图像
+        # SDK子进程调用及numpy/PIL处理期间均会释放GIL，使用线程池并行转换
         if image_files:
-            pbar = tqdm(image_files, desc="转换进度")
-            for filename in pbar:
-                input_path = os.path.join(input_dir, filename)
-                raw_path = os.path.join(temp_dir, f"{os.path.splitext(filename)[0]}.raw")
-                output_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.tiff")
-                
-                # 隐藏DJI SDK的输出
-                devnull = subprocess.DEVNULL if self.platform == "Windows" else os.devnull
-                self._convert_with_dji_sdk(input_path, raw_path, devnull)
-                self._process_raw_image(raw_path, output_path, input_path)
-
-    def _convert_with_dji_sdk(self, input_path: str, raw_path: str, devnull) -> None:
-        """使用DJI Thermal SDK转换图像"""
-        sdk_command = (
-            "dji_thermal_sdk_v1.5_20240507/utility/bin/windows/release_x64/dji_irp.exe "
-            f"-s {input_path} -a measure -o {raw_path}"
-        )
+            errors = []
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = {
+                    executor.submit(self.convert_one, filename, input_dir, output_dir, temp_dir): filename
+                    for filename in image_files
+                }
+                for future in progress(as_completed(futures), len(futures), "转换进度"):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(f"错误: 转换 {futures[future]} 失败 ({str(e)})")
+            
+            # 循环结束后统一输出错误信息，避免打断进度条
+            for error in errors:
+                print(error)
+
+    def convert_one(self, filename: str, input_dir: str, output_dir: str, temp_dir: str,
+                    finalize: Optional[Callable[[str, str], None]] = None) -> str:
+        """
+        转换单个图像：调用DJI SDK生成RAW温度数据，再保存为TIFF，返回TIFF路径
         
-        if self.platform == "Windows":
-            powershell = r"C:\WINDOWS\system32\WindowsPowerShell\v1.0\powershell.exe"
-            subprocess.run([powershell, sdk_command], 
-                         stdout=devnull, 
-                         stderr=devnull,
-                         check=True)
-        else:
-            subprocess.run(sdk_command, 
-                         shell=True, 
-                         stdout=devnull,
-                         stderr=devnull,
-                         check=True)
+        finalize(原图路径, 临时TIFF路径)在TIFF替换到位之前调用（如写入元数据），
+        抛出异常时不会生成TIFF
+        """
+        input_path = os.path.join(input_dir, filename)
+        # 临时文件以完整文件名命名，并行转换时不会与同主干的其他图像冲突
+        raw_path = os.path.join(temp_dir, f"{filename}.raw")
+        output_path = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.tiff")
+        
+        self._convert_with_dji_sdk(input_path, raw_path)
+        self._process_raw_image(raw_path, output_path, input_path, finalize)
+        # 用完即删，临时目录中最多只保留正在处理的RAW文件
+        os.remove(raw_path)
+        return output_path
+
+    def _convert_with_dji_sdk(self, input_path: str, raw_path: str) -> None:
+        """使用DJI Thermal SDK转换图像"""
+        # 直接调用dji_irp，不经过PowerShell或shell，每张图像只创建一个进程
+        subprocess.run(self._sdk_argv_prefix + ["-s", input_path, "-a", "measure", "-o", raw_path],
+                     stdout=self._devnull,
+                     stderr=self._devnull,
+                     check=True)
 
-    def _process_raw_image(self, raw_path: str, output_path: str, original_image_path: str) -> None:
+    def _process_raw_image(self, raw_path: str, output_path: str, original_image_path: str,
+                           finalize: Optional[Callable[[str, str], None]] = None) -> None:
         """处理RAW格式的温度数据并保存为TIFF"""
-        with Image.open(original_image_path) as img:
-            width, height = img.size
+        exif_dict = piexif.load(original_image_path)
+        
+        # 优先从EXIF读取图像尺寸，缺失或与RAW数据大小不符时才打开原图获取
+        raw_size = os.path.getsize(raw_path)
+        width = exif_dict['Exif'].get(piexif.ExifIFD.PixelXDimension)
+        height = exif_dict['Exif'].get(piexif.ExifIFD.PixelYDimension)
+        if not width or not height or width * height * 2 != raw_size:
+            with Image.open(original_image_path) as img:
+                width, height = img.size
+        # memmap不检查文件大小，尺寸不符时会生成错位的TIFF，因此在映射前校验
+        if width * height * 2 != raw_size:
+            raise ValueError(f"RAW数据大小({raw_size}字节)与图像尺寸{width}x{height}不符")
 
-        img_data = np.fromfile(raw_path, dtype='int16')
-        img_data = img_data.reshape(height, width) / 10  # 转换为摄氏度
+        # 内存映射读取int16原始数据，直接以float32相乘得到摄氏度，避免float64中间结果
+        # 结果写入线程内复用的缓冲区；Image.fromarray会复制数据，缓冲区可在下一张图像中复用
+        raw = np.memmap(raw_path, dtype='<i2', mode='r', shape=(height, width))
+        img_data = np.multiply(raw, np.float32(0.1), out=_get_buffer((height, width)))  # 转换为摄氏度
+        del raw  # 及时释放映射，避免Windows下临时文件被占用无法删除
 
         # 保留GPS信息
-        exif_dict = piexif.load(original_image_path)
         new_exif = {
             '0th': {},
             'Exif': {},
@@ -142,7 +239,20 @@ class ImageProcessor:
         }
         exif_bytes = piexif.dump(new_exif)
         
-        Image.fromarray(img_data).save(output_path, exif=exif_bytes)
+        # 先写入临时文件再替换，中断时不会留下不完整的TIFF被误判为已转换
+        # 临时文件以原图完整文件名命名，并行转换时不会与同主干的其他图像冲突
+        partial_path = os.path.join(os.path.dirname(output_path),
+                                    f"{os.path.basename(original_image_path)}.tiff.part")
+        try:
+            Image.fromarray(img_data).save(partial_path, format="TIFF", exif=exif_bytes)
+            if finalize is not None:
+                finalize(original_image_path, partial_path)
+        except Exception:
+            # 写入失败时删除残留的临时文件，避免其留在out_dir中
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.replace(partial_path, output_path)
 
 if __name__ == "__main__":
     # 设置命令行参数
@@ -1,20 +1,67 @@
 import os
+import shutil
 import argparse
-from extract_metadata import MetadataProcessor
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, Optional, Tuple
+from extract_metadata import MetadataProcessor, extract_metadata, pool_chunksize, pool_workers
 from jpg2tiff import ImageProcessor
-from copy_metadata import MetadataCopier
+from copy_metadata import copy_metadata
 
 """
 DJI 热红外图像处理工具
 
 功能描述:
 ---------
-按顺序执行以下处理:
+对每张图像在同一个工作进程中依次执行以下处理:
 1. 提取图像元数据 (extract_metadata.py)
 2. JPG转换为TIFF (jpg2tiff.py)
 3. 复制元数据到TIFF (copy_metadata.py)
+
+每张图像只需从磁盘读取一次即可完成全部步骤，三个脚本仍可单独运行
 """
 
+def _copy_metadata_or_raise(src_path: str, dst_path: str) -> None:
+    """复制元数据到尚未替换到位的临时TIFF，失败时抛出异常使该TIFF不被保留"""
+    success, error = copy_metadata(src_path, dst_path)
+    if not success:
+        raise RuntimeError(error)
+
+def process_image(image_processor: ImageProcessor, filename: str, input_dir: str,
+                  output_dir: str, temp_dir: str, convert: bool) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    """
+    对单张图像执行完整处理流程（模块级函数，便于在进程池中调用）
+    
+    参数:
+        image_processor: 图像转换器
+        filename: input_dir中的图像文件名
+        input_dir, output_dir, temp_dir: 所在子文件夹的各处理目录
+        convert: 是否需要转换（已有对应TIFF时为False，该TIFF在生成时已写入元数据，不再重复写入）
+        
+    返回值:
+        (元数据字典, 警告或错误信息)，信息由主进程统一输出
+    """
+    input_path = os.path.join(input_dir, filename)
+    messages = []
+    
+    # 步骤 1: 提取元数据（与extract_metadata.py一致，仅处理JPG文件）
+    metadata = None
+    if filename.lower().endswith('.jpg'):
+        metadata, error = extract_metadata(input_path)
+        if error:
+            messages.append(error)
+    
+    # 步骤 2、3: 转换图像格式，并在TIFF替换到位之前复制元数据，
+    # 因此out_dir中已存在的TIFF必然带有元数据，重复运行时无需再打开
+    if convert:
+        try:
+            image_processor.convert_one(filename, input_dir, output_dir, temp_dir,
+                                        finalize=_copy_metadata_or_raise)
+        except Exception as e:
+            messages.append(f"错误: 转换 {filename} 失败 ({str(e)})")
+    
+    return metadata, '\n'.join(messages) or None
+
 class ProcessManager:
     """处理管理器"""
     
@@ -29,20 +76,25 @@ class ProcessManager:
 
     def run_all(self) -> None:
         """
-        按顺序执行所有处理步骤
+        逐个子文件夹执行所有处理步骤，每张图像在一个任务中完成全部步骤
         """
         try:
-            print("\n===== 步骤 1: 提取元数据 =====")
             metadata_processor = MetadataProcessor()
-            metadata_processor.process_all(self.directory)
-
-            print("\n===== 步骤 2: 转换图像格式 =====")
             image_processor = ImageProcessor()
-            image_processor.process_subfolders(self.directory)
-
-            print("\n===== 步骤 3: 复制元数据 =====")
-            metadata_copier = MetadataCopier()
-            metadata_copier.process_all(self.directory)
+            
+            subfolders = image_processor.find_subfolders(self.directory)
+            
+            if not subfolders:
+                # 图像直接位于根目录时与单独运行extract_metadata.py一致，只提取元数据
+                print("未找到子文件夹，仅提取当前目录的元数据")
+                metadata_processor.process_folder(self.directory)
+                return
+            
+            # 所有子文件夹共用一个进程池
+            with ProcessPoolExecutor(max_workers=pool_workers()) as executor:
+                for subfolder in subfolders:
+                    print(f"\n===== 处理: {subfolder.name} =====")
+                    self._run_folder(executor, metadata_processor, image_processor, subfolder.path)
 
             print("\n===== 所有处理完成! =====")
 
@@ -50,6 +102,35 @@ class ProcessManager:
             print(f"\n错误: 处理过程中出现异常: {str(e)}")
             raise
 
+    def _run_folder(self, executor: ProcessPoolExecutor, metadata_processor: MetadataProcessor,
+                    image_processor: ImageProcessor, folder_path: str) -> None:
+        """
+        处理单个子文件夹：整理图像后将每张图像作为一个任务分发到进程池
+        
+        参数:
+            executor: 共用的进程池
+            metadata_processor: 负责汇总并写入metadata.txt
+            image_processor: 负责整理目录及转换图像
+            folder_path: 子文件夹路径
+        """
+        input_dir, output_dir, temp_dir = image_processor.create_folder_dirs(folder_path)
+        try:
+            input_files, image_files = image_processor.collect_images(folder_path, input_dir, output_dir)
+            if not input_files:
+                print(f"警告: {folder_path} 中未找到图像文件")
+                return
+            
+            pending = set(image_files)
+            results = executor.map(process_image, repeat(image_processor), input_files,
+                                   repeat(input_dir), repeat(output_dir), repeat(temp_dir),
+                                   [filename in pending for filename in input_files],
+                                   chunksize=pool_chunksize(len(input_files)))
+            # 结果按文件顺序返回，由主进程汇总写入metadata.txt
+            metadata_processor.write_results(results, len(input_files), folder_path, desc="处理进度")
+        finally:
+            # 清理临时目录
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
 def main():
     """主函数"""
     # 设置命令行参数